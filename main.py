@@ -1,17 +1,117 @@
+import itertools
+import logging
+import os
+import re
+import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple, cast
 
-import matplotlib.pyplot as plt
 import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
 import requests
 import streamlit as st
 from lxml import etree
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
+logger = logging.getLogger(__name__)
+
+# SEC request utilities
+# Accept-Encoding is left to requests, which asks for gzip and deflate plus br
+# and zstd when those decoders are installed, and decompresses the responses
+SEC_HEADERS = {"User-Agent": "Your Name contact@yourdomain.com"}
+REQUEST_TIMEOUT = 12
+# The submissions feed is re-checked hourly for new filings, while a filing
+# itself never changes once published, so its holdings are kept much longer.
+SUBMISSIONS_TTL = 60 * 60
+FILING_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 256
+XML_CHUNK_SIZE = 64 * 1024
+# Kept well under the SEC's 10 requests per second guidance
+PREWARM_MAX_WORKERS = 4
+# Comma-separated CIKs whose holdings are cached in the background on startup
+PREWARM_CIKS = tuple(
+    cik.strip() for cik in os.environ.get("PREWARM_CIKS", "").split(",") if cik.strip()
+)
+
+# Surrounding whitespace is allowed since the input is stripped before fetching
+CIK_PATTERN = re.compile(r"\s*([0-9]+)\s*")
+
+# NPORT-P parsing utilities
+NPORT_NS = "http://www.sec.gov/edgar/nport"
+# We recover since the SEC can have strange XML sometimes. Large filings need
+# huge_tree, and entity/DTD/network handling is never needed for NPORT-P data.
+NPORT_PARSER_OPTIONS: Dict[str, bool] = {
+    "recover": True,
+    "huge_tree": True,
+    "resolve_entities": False,
+    "no_network": True,
+    "collect_ids": False,
+}
+# Clark-notation tags let lxml match holdings without namespace resolution
+INVST_OR_SEC_TAG = f"{{{NPORT_NS}}}invstOrSec"
+HOLDING_FIELDS: Dict[str, str] = {
+    "Title": f"{{{NPORT_NS}}}title",
+    "CUSIP": f"{{{NPORT_NS}}}cusip",
+    "Balance": f"{{{NPORT_NS}}}balance",
+    "Value": f"{{{NPORT_NS}}}valUSD",
+}
+# Lowercased titles stored alongside the holdings for case-insensitive filtering
+TITLE_SEARCH_COLUMN = "_TitleLower"
+
 # Rate limit utilities
-IP_REQUESTS: Dict[str, List[float]] = {}
+# Sliding window state per IP: (window index, previous count, current count)
+IP_REQUESTS: Dict[str, Tuple[int, int, int]] = {}
 RATE_LIMIT = 10
 MAX_REQUESTS = 5
+RATE_LIMIT_SWEEP_INTERVAL = 1024
+_RATE_LIMIT_TICKS = itertools.count(1)
+
+
+def sweep_rate_limits(now: float) -> None:
+    """
+    Drops rate limit state for IPs with no requests in the last two windows,
+    since their counts no longer affect any rate limit decision.
+
+    Args:
+        now (float): The current time in seconds since the epoch.
+    """
+    window = int(now // RATE_LIMIT)
+    for client_ip, (last_window, _, _) in list(IP_REQUESTS.items()):
+        if last_window < window - 1:
+            del IP_REQUESTS[client_ip]
+
+
+def is_rate_limited(client_ip: str, now: float) -> bool:
+    """
+    Records a request from the client and checks it against the rate limit.
+
+    Uses a sliding window approximated by two fixed windows of RATE_LIMIT
+    seconds: the previous window's count is weighted by how much of it still
+    overlaps the last RATE_LIMIT seconds. Requests that are rejected are not
+    counted. Stale IPs are swept every RATE_LIMIT_SWEEP_INTERVAL requests.
+
+    Args:
+        client_ip (str): The IP address of the client making the request.
+        now (float): The current time in seconds since the epoch.
+
+    Returns:
+        bool: True if the request exceeds the rate limit, else False.
+    """
+    if next(_RATE_LIMIT_TICKS) % RATE_LIMIT_SWEEP_INTERVAL == 0:
+        sweep_rate_limits(now)
+
+    window = int(now // RATE_LIMIT)
+    last_window, previous, current = IP_REQUESTS.get(client_ip, (window, 0, 0))
+    if window != last_window:
+        previous = current if window == last_window + 1 else 0
+        current = 0
+
+    overlap = 1 - (now % RATE_LIMIT) / RATE_LIMIT
+    limited = previous * overlap + current >= MAX_REQUESTS
+    IP_REQUESTS[client_ip] = (window, previous, current if limited else current + 1)
+    return limited
 
 
 def validate_cik(cik_input: str) -> Optional[str]:
@@ -24,70 +124,298 @@ def validate_cik(cik_input: str) -> Optional[str]:
     Returns:
         Optional[str]: None if valid, or an error message if invalid.
     """
-    if not cik_input.strip().isdigit():
+    match = CIK_PATTERN.fullmatch(cik_input)
+    if match is None:
         return "Invalid CIK input. Please enter digits only."
 
-    if len(cik_input.strip()) > 10:
+    if len(match.group(1)) > 10:
         return "Invalid CIK input. CIK should be 10 digits or less."
 
     return None
 
 
-@st.cache_data(show_spinner=False)
-def fetch_holdings(cik_input: str) -> Optional[List[Dict[str, Optional[str]]]]:
+class SecFetchError(Exception):
+    """
+    Raised by the cached SEC fetchers when a request fails or returns an error
+    status. Streamlit does not cache exceptions, so the next lookup retries
+    instead of reusing the failure, and only successful results are cached.
+    """
+
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    """
+    Shared HTTP session for SEC requests. Cached as a resource so the pooled
+    keep-alive connections to data.sec.gov and www.sec.gov survive reruns.
+
+    Returns:
+        requests.Session: The session with the SEC headers applied.
+    """
+    session = requests.Session()
+    session.headers.update(SEC_HEADERS)
+    return session
+
+
+@st.cache_data(show_spinner=False, ttl=SUBMISSIONS_TTL, max_entries=CACHE_MAX_ENTRIES)
+def fetch_latest_nport_accession(cik_padded: str) -> Optional[str]:
     """
-    Fetch holdings data for the given CIK. Cached to reduce redundant API calls.
+    Fetch the accession number of the latest NPORT-P filing for the given CIK.
+    Cached briefly so newly published filings are picked up.
 
     Args:
-        cik_input (str): The CIK provided by the user.
+        cik_padded (str): The CIK zero-padded to 10 digits.
 
     Returns:
-        Optional[List[Dict[str, Optional[str]]]]: A list of holdings dictionaries if successful, else None.
+        Optional[str]: The accession number without dashes if found, else None.
+
+    Raises:
+        SecFetchError: If the submissions feed could not be fetched.
     """
-    cik_padded = cik_input.zfill(10)
     json_url = f"https://data.sec.gov/submissions/CIK{cik_padded}.json"
-    headers = {"User-Agent": "Your Name contact@yourdomain.com"}
-    response = requests.get(json_url, headers=headers)
-    if response.status_code != 200:
-        st.error(f"Failed to fetch JSON data. Status code: {response.status_code}")
-        return None
+    try:
+        response = get_session().get(json_url, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise SecFetchError(
+                f"Failed to fetch JSON data. Status code: {response.status_code}"
+            )
+
+        data = response.json()
+    except requests.RequestException as exc:
+        raise SecFetchError(f"Failed to fetch JSON data. Error: {exc}") from exc
 
-    data = response.json()
     recent = data.get("filings", {}).get("recent", {})
     forms = recent.get("form", [])
 
-    # Find indices where form == 'NPORT-P' for latest NPORT-P filing
-    nport_p_indices = [i for i, form in enumerate(forms) if form == "NPORT-P"]
-    if not nport_p_indices:
+    # Filings are newest first, so stop at the first NPORT-P
+    latest_index = next((i for i, form in enumerate(forms) if form == "NPORT-P"), None)
+    if latest_index is None:
         st.info("No NPORT-P filings found.")
         return None
 
-    latest_index = nport_p_indices[0]
-    acc_no_clean = recent["accessionNumber"][latest_index].replace("-", "")
+    return cast(str, recent["accessionNumber"][latest_index]).replace("-", "")
+
+
+def iter_holding_elements(chunks: Iterable[bytes]) -> Iterator[etree._Element]:
+    """
+    Stream the invstOrSec elements of an NPORT-P filing one at a time as its
+    bytes arrive, rather than building the whole tree. Each element is cleared
+    once the caller has moved on to the next one.
+
+    Args:
+        chunks (Iterable[bytes]): The raw NPORT-P XML document in chunks.
+
+    Yields:
+        etree._Element: Each invstOrSec element in document order.
+    """
+    parser = etree.XMLPullParser(
+        events=("end",), tag=INVST_OR_SEC_TAG, **NPORT_PARSER_OPTIONS
+    )
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from _read_holding_events(parser)
+    parser.close()
+    yield from _read_holding_events(parser)
+
+
+def _read_holding_events(parser: etree.XMLPullParser) -> Iterator[etree._Element]:
+    """
+    Yield the invstOrSec elements the parser has completed so far, clearing
+    each one after the caller is done with it.
+
+    Args:
+        parser (etree.XMLPullParser): The parser being fed the NPORT-P document.
+
+    Yields:
+        etree._Element: Each completed invstOrSec element in document order.
+    """
+    for _, sec in parser.read_events():
+        yield sec
+
+        # Release the parsed holding and any siblings already processed
+        sec.clear()
+        while sec.getprevious() is not None:
+            del sec.getparent()[0]
+
+
+@st.cache_data(show_spinner=False, ttl=FILING_TTL, max_entries=CACHE_MAX_ENTRIES)
+def fetch_nport_holdings(cik_padded: str, acc_no_clean: str) -> pd.DataFrame:
+    """
+    Fetch and parse the holdings of a single NPORT-P filing into a DataFrame
+    with numeric 'Balance' and 'Value' columns and a lowercased title column for
+    filtering. Keyed on the accession number, so a new filing is fetched as soon
+    as it is the latest, and reruns reuse the converted DataFrame.
+
+    Args:
+        cik_padded (str): The CIK zero-padded to 10 digits.
+        acc_no_clean (str): The accession number of the filing without dashes.
+
+    Returns:
+        pd.DataFrame: The holdings DataFrame.
+
+    Raises:
+        SecFetchError: If the filing could not be fetched.
+    """
     xml_url = f"https://www.sec.gov/Archives/edgar/data/{cik_padded}/{acc_no_clean}/primary_doc.xml"
-    response_xml = requests.get(xml_url, headers=headers)
-    if response_xml.status_code != 200:
-        st.error("Failed to fetch XML")
+    title_tag, cusip_tag, balance_tag, value_tag = HOLDING_FIELDS.values()
+    # Parse while downloading so the full document is never buffered in memory
+    try:
+        with get_session().get(
+            xml_url, timeout=REQUEST_TIMEOUT, stream=True
+        ) as response_xml:
+            if response_xml.status_code != 200:
+                raise SecFetchError("Failed to fetch XML")
+
+            records = [
+                (
+                    sec.findtext(title_tag),
+                    sec.findtext(cusip_tag),
+                    sec.findtext(balance_tag),
+                    sec.findtext(value_tag),
+                )
+                for sec in iter_holding_elements(
+                    response_xml.iter_content(XML_CHUNK_SIZE)
+                )
+            ]
+    except requests.RequestException as exc:
+        # Includes read timeouts partway through the streamed download
+        raise SecFetchError(f"Failed to fetch XML. Error: {exc}") from exc
+
+    # Every holding has the same fields, so skip pandas inferring the columns
+    df = pd.DataFrame.from_records(records, columns=list(HOLDING_FIELDS))
+    df["Balance"] = pd.to_numeric(df["Balance"], errors="coerce")
+    df["Value"] = pd.to_numeric(df["Value"], errors="coerce")
+    df[TITLE_SEARCH_COLUMN] = df["Title"].str.lower()
+    return df
+
+
+def fetch_holdings_df(cik_input: str) -> Optional[pd.DataFrame]:
+    """
+    Fetch holdings from the latest NPORT-P filing for the given CIK. Both SEC
+    lookups are cached to reduce redundant API calls, while failed requests are
+    reported here and retried on the next call.
+
+    Args:
+        cik_input (str): The CIK provided by the user.
+
+    Returns:
+        Optional[pd.DataFrame]: The holdings DataFrame if successful, else None.
+    """
+    cik_padded = cik_input.zfill(10)
+    try:
+        acc_no_clean = fetch_latest_nport_accession(cik_padded)
+        if acc_no_clean is None:
+            return None
+
+        return fetch_nport_holdings(cik_padded, acc_no_clean)
+    except SecFetchError as exc:
+        st.error(str(exc))
         return None
 
-    decoded_content = response_xml.content
-    parser = etree.XMLParser(
-        recover=True
-    )  # We recover since the SEC can have strange XML sometimes
-    root = etree.fromstring(decoded_content, parser=parser)
-    ns_default = root.nsmap.get(None)
-    nsmap = {"nport": ns_default} if ns_default else {}
-
-    holdings: List[Dict[str, Optional[str]]] = []
-    for sec in root.xpath(".//nport:invstOrSec", namespaces=nsmap):
-        holding = {
-            "Title": sec.findtext("nport:title", namespaces=nsmap),
-            "CUSIP": sec.findtext("nport:cusip", namespaces=nsmap),
-            "Balance": sec.findtext("nport:balance", namespaces=nsmap),
-            "Value": sec.findtext("nport:valUSD", namespaces=nsmap),
-        }
-        holdings.append(holding)
-    return holdings
+
+def prewarm_holdings(ciks: Iterable[str]) -> Dict[str, bool]:
+    """
+    Populate the holdings caches for several CIKs concurrently, e.g. after the
+    SEC publishes new filings, so users do not pay for the cold fetch. Each
+    CIK's two SEC requests depend on each other, so CIKs are fetched in parallel
+    rather than the requests within one CIK.
+
+    Args:
+        ciks (Iterable[str]): The CIKs to fetch. Invalid CIKs are skipped.
+
+    Returns:
+        Dict[str, bool]: Whether holdings were cached for each valid CIK.
+    """
+    valid_ciks = [cik.strip() for cik in ciks if validate_cik(cik) is None]
+    with ThreadPoolExecutor(max_workers=PREWARM_MAX_WORKERS) as executor:
+        futures = {cik: executor.submit(fetch_holdings_df, cik) for cik in valid_ciks}
+
+    cached: Dict[str, bool] = {}
+    for cik, future in futures.items():
+        # One failing CIK should not lose the results of the others
+        try:
+            cached[cik] = future.result() is not None
+        except Exception:
+            logger.exception("Failed to pre-warm holdings for CIK %s", cik)
+            cached[cik] = False
+    return cached
+
+
+@st.cache_resource(ttl=SUBMISSIONS_TTL)
+def start_prewarm(ciks: Tuple[str, ...]) -> Optional[threading.Thread]:
+    """
+    Starts pre-warming the holdings caches for the given CIKs in a background
+    thread. Cached as a resource so it runs once per server process, and again
+    on the first visit after each SUBMISSIONS_TTL to pick up new filings.
+
+    Args:
+        ciks (Tuple[str, ...]): The CIKs to pre-warm, usually PREWARM_CIKS.
+
+    Returns:
+        Optional[threading.Thread]: The pre-warm thread, or None if there are no CIKs.
+    """
+    if not ciks:
+        return None
+
+    thread = threading.Thread(target=prewarm_holdings, args=(ciks,), daemon=True)
+    thread.start()
+    return thread
+
+
+@st.cache_resource(max_entries=32)
+def build_pie_chart(
+    titles: Tuple[str, ...],
+    values: Tuple[float, ...],
+    threshold_pct: float,
+    top_n: int,
+) -> go.Figure:
+    """
+    Builds the holdings pie chart. The chart is rendered in the browser, and is
+    cached as a resource so reruns that plot the same slices reuse the figure.
+
+    Args:
+        titles (Tuple[str, ...]): The label of each slice.
+        values (Tuple[float, ...]): The USD value of each slice.
+        threshold_pct (float): The percentage below which holdings were grouped as 'Other'.
+        top_n (int): The number of largest holdings shown outside of 'Other'.
+
+    Returns:
+        go.Figure: The pie chart figure.
+    """
+    # Plotly sums slices that share a label, so number repeated titles to keep
+    # each holding as its own slice
+    seen: Dict[str, int] = {}
+    labels = []
+    for title in titles:
+        seen[title] = seen.get(title, 0) + 1
+        labels.append(title if seen[title] == 1 else f"{title} ({seen[title]})")
+
+    fig = px.pie(names=labels, values=list(values))
+    fig.update_traces(
+        sort=False,
+        direction="counterclockwise",
+        texttemplate="%{label}<br><b>%{percent:.1%}</b>",
+    )
+
+    footnote = (
+        f"<i>Note: Holdings below {threshold_pct}% or outside the top {top_n} "
+        "shown as 'Other'</i>"
+    )
+    fig.update_layout(
+        title={"text": "Holdings by Total USD Value", "font": {"size": 16}},
+        legend_title_text="Holdings Detail",
+        annotations=[
+            {
+                "text": footnote,
+                "x": 0.5,
+                "y": -0.1,
+                "xref": "paper",
+                "yref": "paper",
+                "showarrow": False,
+                "font": {"size": 10},
+            }
+        ],
+    )
+    return fig
 
 
 def main() -> None:
@@ -95,6 +423,7 @@ def main() -> None:
     Streamlit application entry point to display prospect capital holdings.
     """
     st.title("Prospect Capital Holdings Viewer")
+    start_prewarm(PREWARM_CIKS)
 
     ctx = get_script_run_ctx()
     client_ip = (
@@ -102,16 +431,9 @@ def main() -> None:
         if ctx and hasattr(ctx, "request") and ctx.request
         else "unknown"
     )
-    if client_ip not in IP_REQUESTS:
-        IP_REQUESTS[client_ip] = []
-    current_time = time.time()
-    IP_REQUESTS[client_ip] = [
-        t for t in IP_REQUESTS[client_ip] if current_time - t < RATE_LIMIT
-    ]
-    if len(IP_REQUESTS[client_ip]) >= MAX_REQUESTS:
+    if is_rate_limited(client_ip, time.time()):
         st.warning("Rate limit exceeded. Please try again later.")
         return
-    IP_REQUESTS[client_ip].append(current_time)
 
     if "holdings_df" not in st.session_state:
         st.session_state.holdings_df = None
@@ -144,80 +466,57 @@ def main() -> None:
 
     if st.button("Fetch Holdings") and cik_input:
         with st.spinner("Fetching data..."):
-            holdings = fetch_holdings(cik_input.strip())
-            if holdings is not None:
+            holdings_df = fetch_holdings_df(cik_input.strip())
+            if holdings_df is not None:
                 st.success("Data fetched successfully.")
-                st.session_state.holdings_df = pd.DataFrame(holdings)
+                st.session_state.holdings_df = holdings_df
 
     if st.session_state.holdings_df is not None:
-        df = st.session_state.holdings_df.copy()
+        df = st.session_state.holdings_df
 
         if filter_keyword:
-            df = df[df["Title"].str.contains(filter_keyword, case=False, na=False)]
+            df = df[
+                df[TITLE_SEARCH_COLUMN].str.contains(
+                    filter_keyword.lower(), regex=False, na=False
+                )
+            ]
 
-        st.dataframe(df)  # Create the sortable table
+        # Create the sortable table
+        st.dataframe(df, column_order=list(HOLDING_FIELDS))
 
         # Creates a pie chart if there is a 'Value' column in the DataFrame
         if "Value" in df.columns:
-            chart_data = df[["Title", "Value"]].dropna()
-            chart_data["Value"] = pd.to_numeric(chart_data["Value"], errors="coerce")
-            chart_data = chart_data.sort_values("Value", ascending=False)
+            # Select and drop missing rows in one step; df itself is never mutated
+            has_values = df["Title"].notna() & df["Value"].notna()
+            chart_data = df.loc[has_values, ["Title", "Value"]].sort_values(
+                "Value", ascending=False
+            )
 
             if not chart_data.empty:
-                fig, ax = plt.subplots(figsize=(10, 8))
-
-                ax.set_title("Holdings by Total USD Value", fontsize=16, pad=20)
-
                 total_value = chart_data["Value"].sum()
 
-                main_holdings = chart_data[
-                    chart_data["Value"] / total_value * 100 >= threshold_pct
-                ].copy()
-                small_holdings = chart_data[
-                    chart_data["Value"] / total_value * 100 < threshold_pct
-                ].copy()
-
-                if not small_holdings.empty:
-                    other_value = small_holdings["Value"].sum()
+                values = chart_data["Value"].to_numpy()
+                is_main = values / total_value * 100 >= threshold_pct
+                # chart_data is sorted, so this caps the legend at top_n holdings
+                is_main[top_n:] = False
+                other_count = int((~is_main).sum())
+                plot_data = chart_data[is_main]
+                if other_count:
                     other_row = pd.DataFrame(
-                        {"Title": ["Other"], "Value": [other_value]}
+                        {
+                            "Title": [f"Other ({other_count} holdings)"],
+                            "Value": [values[~is_main].sum()],
+                        }
                     )
-                    plot_data = pd.concat([main_holdings, other_row])
-                else:
-                    plot_data = main_holdings
-
-                wedges, texts, autotexts = cast(
-                    Tuple[List[Any], List[Any], List[Any]],
-                    ax.pie(
-                        plot_data["Value"],
-                        labels=plot_data["Title"],
-                        autopct="%1.1f%%",
-                        startangle=90,
-                        pctdistance=0.85,
-                    ),
-                )
-
-                ax.axis("equal")
-                legend_items = chart_data["Title"].head(top_n).tolist()
-                if len(chart_data) > top_n:
-                    legend_items.append(f"Others ({len(chart_data) - top_n} holdings)")
-
-                plt.legend(
-                    title="Holdings Detail",
-                    loc="center left",
-                    bbox_to_anchor=(1, 0, 0.5, 1),
-                )
+                    plot_data = pd.concat([plot_data, other_row])
 
-                footnote = f"Note: Holdings below {threshold_pct}% shown as 'Other'"
-                fig.text(
-                    0.5, 0.01, footnote, ha="center", fontsize=10, fontstyle="italic"
+                fig = build_pie_chart(
+                    tuple(plot_data["Title"].tolist()),
+                    tuple(plot_data["Value"].tolist()),
+                    threshold_pct,
+                    top_n,
                 )
-
-                plt.setp(autotexts, size=10, weight="bold")
-                plt.setp(texts, size=11)
-
-                plt.tight_layout()
-                st.pyplot(fig)
+                st.plotly_chart(fig)
         else:
             st.error(
                 "The data does not contain 'Value' information required for visualization."
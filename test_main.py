@@ -1,10 +1,23 @@
 import time
 from unittest.mock import MagicMock, patch
 
+import pandas as pd
 import pytest
+import requests
 import streamlit as st
+from lxml import etree
 
-from main import fetch_holdings, main
+from main import (
+    TITLE_SEARCH_COLUMN,
+    build_pie_chart,
+    fetch_holdings_df,
+    is_rate_limited,
+    main,
+    prewarm_holdings,
+    start_prewarm,
+    sweep_rate_limits,
+    validate_cik,
+)
 
 
 # This is a helper for getting attributes from a dictionary using dot notation with session state and Streamlit.
@@ -19,6 +32,12 @@ class DotDict(dict):
         self[key] = value
 
 
+@pytest.fixture(autouse=True)
+def clear_streamlit_cache():
+    """Clear cached SEC responses so each test sees its own mocked data."""
+    st.cache_data.clear()
+
+
 @pytest.fixture
 def mock_successful_json_response():
     """Fixture for mocking a successful JSON response from SEC API."""
@@ -39,12 +58,18 @@ def mock_successful_json_response():
     return mock_response
 
 
-@pytest.fixture
-def mock_successful_xml_response():
-    """Fixture for mocking a successful XML response from SEC API."""
+def make_xml_response(xml_content):
+    """Build a mocked streamed XML response that arrives in two chunks."""
     mock_response = MagicMock()
     mock_response.status_code = 200
+    mock_response.__enter__.return_value = mock_response
+    mock_response.iter_content.return_value = [xml_content[:100], xml_content[100:]]
+    return mock_response
+
 
+@pytest.fixture
+def mock_successful_xml_response():
+    """Fixture for mocking a successful XML response from SEC API."""
     xml_content = """
     <report xmlns="http://www.sec.gov/edgar/nport">
         <holdings>
@@ -64,8 +89,7 @@ def mock_successful_xml_response():
     </report>
     """.encode("utf-8")
 
-    mock_response.content = xml_content
-    return mock_response
+    return make_xml_response(xml_content)
 
 
 @pytest.fixture
@@ -97,50 +121,66 @@ def mock_error_xml_response():
     """Fixture for mocking a failed XML response from SEC API."""
     mock_response = MagicMock()
     mock_response.status_code = 404
+    mock_response.__enter__.return_value = mock_response
     return mock_response
 
 
+@pytest.mark.parametrize(
+    "cik_input, expected",
+    [
+        ("1234567890", None),
+        (" 0001234 ", None),
+        ("12a34", "Invalid CIK input. Please enter digits only."),
+        ("   ", "Invalid CIK input. Please enter digits only."),
+        ("12345678901", "Invalid CIK input. CIK should be 10 digits or less."),
+    ],
+)
+def test_validate_cik(cik_input, expected):
+    """Test validate_cik accepts padded digits and rejects other input."""
+    assert validate_cik(cik_input) == expected
+
+
 def test_fetch_holdings_success(
     mock_successful_json_response, mock_successful_xml_response
 ):
-    """Test fetch_holdings function with successful responses."""
-    with patch("requests.get") as mock_get:
-        mock_get.side_effect = lambda url, headers: (
+    """Test fetch_holdings_df function with successful responses."""
+    with patch("requests.Session.get") as mock_get:
+        mock_get.side_effect = lambda url, **kwargs: (
             mock_successful_json_response
             if "CIK" in url
             else mock_successful_xml_response
         )
 
-        holdings = fetch_holdings("1234567890")
+        holdings = fetch_holdings_df("1234567890")
 
         assert holdings is not None
         assert len(holdings) == 2
-        assert holdings[0]["Title"] == "Company A Bond"
-        assert holdings[0]["CUSIP"] == "123456789"
-        assert holdings[0]["Balance"] == "1000"
-        assert holdings[0]["Value"] == "10000"
-        assert holdings[1]["Title"] == "Company B Stock"
+        assert holdings["Title"].iloc[0] == "Company A Bond"
+        assert holdings["CUSIP"].iloc[0] == "123456789"
+        assert holdings["Balance"].iloc[0] == 1000
+        assert holdings["Value"].iloc[0] == 10000
+        assert holdings["Title"].iloc[1] == "Company B Stock"
 
 
 def test_fetch_holdings_json_error(mock_error_json_response):
-    """Test fetch_holdings function with JSON API error."""
-    with patch("requests.get") as mock_get:
+    """Test fetch_holdings_df function with JSON API error."""
+    with patch("requests.Session.get") as mock_get:
         mock_get.return_value = mock_error_json_response
 
         with patch("streamlit.error") as mock_st_error:
-            holdings = fetch_holdings("1234567890")
+            holdings = fetch_holdings_df("1234567890")
 
             assert holdings is None
             mock_st_error.assert_called_once()
 
 
 def test_fetch_holdings_no_nport(mock_no_nport_response):
-    """Test fetch_holdings function with no NPORT-P filings."""
-    with patch("requests.get") as mock_get:
+    """Test fetch_holdings_df function with no NPORT-P filings."""
+    with patch("requests.Session.get") as mock_get:
         mock_get.return_value = mock_no_nport_response
 
         with patch("streamlit.info") as mock_st_info:
-            holdings = fetch_holdings("1234567890")
+            holdings = fetch_holdings_df("1234567890")
 
             assert holdings is None
             mock_st_info.assert_called_once_with("No NPORT-P filings found.")
@@ -149,17 +189,231 @@ def test_fetch_holdings_no_nport(mock_no_nport_response):
 def test_fetch_holdings_xml_error(
     mock_successful_json_response, mock_error_xml_response
 ):
-    """Test fetch_holdings function with XML API error."""
-    with patch("requests.get") as mock_get:
+    """Test fetch_holdings_df function with XML API error."""
+    with patch("requests.Session.get") as mock_get:
         mock_get.side_effect = [mock_successful_json_response, mock_error_xml_response]
 
         with patch("streamlit.error") as mock_st_error:
-            holdings = fetch_holdings("1234567890")
+            holdings = fetch_holdings_df("1234567890")
 
             assert holdings is None
             mock_st_error.assert_called_once_with("Failed to fetch XML")
 
 
+def test_fetch_holdings_df_numeric_columns(mock_successful_json_response):
+    """Test fetch_holdings_df converts 'Balance' and 'Value' to numbers."""
+    xml_response = make_xml_response(
+        b"""
+        <report xmlns="http://www.sec.gov/edgar/nport">
+            <invstOrSec>
+                <title>Test Stock</title>
+                <balance>100</balance>
+                <valUSD>1000</valUSD>
+            </invstOrSec>
+            <invstOrSec>
+                <title>Test Bond</title>
+                <balance>50</balance>
+                <valUSD>N/A</valUSD>
+            </invstOrSec>
+        </report>
+        """
+    )
+    with patch("requests.Session.get") as mock_get:
+        mock_get.side_effect = [mock_successful_json_response, xml_response]
+
+        df = fetch_holdings_df("1234567890")
+
+    assert df is not None
+    assert df["Balance"].tolist() == [100, 50]
+    assert df["Value"].iloc[0] == 1000
+    assert pd.isna(df["Value"].iloc[1])
+    assert df["CUSIP"].isna().all()
+    assert df[TITLE_SEARCH_COLUMN].tolist() == ["test stock", "test bond"]
+
+
+def test_fetch_holdings_df_no_holdings(mock_successful_json_response):
+    """Test fetch_holdings_df keeps the holding columns for an empty filing."""
+    xml_response = make_xml_response(
+        b'<report xmlns="http://www.sec.gov/edgar/nport"><holdings/></report>'
+    )
+    with patch("requests.Session.get") as mock_get:
+        mock_get.side_effect = [mock_successful_json_response, xml_response]
+
+        df = fetch_holdings_df("1234567890")
+
+    assert df is not None
+    assert df.empty
+    assert df.columns[:4].tolist() == ["Title", "CUSIP", "Balance", "Value"]
+
+
+def test_fetch_holdings_df_new_filing(
+    mock_successful_json_response, mock_successful_xml_response
+):
+    """Test a new latest accession bypasses the cached holdings of the old one."""
+    with (
+        patch("main.fetch_latest_nport_accession") as mock_accession,
+        patch(
+            "requests.Session.get", return_value=mock_successful_xml_response
+        ) as mock_get,
+    ):
+        mock_accession.return_value = "000123456722000123"
+        fetch_holdings_df("1234567890")
+        fetch_holdings_df("1234567890")
+        assert mock_get.call_count == 1
+
+        mock_accession.return_value = "000123456722000124"
+        fetch_holdings_df("1234567890")
+        assert mock_get.call_count == 2
+        assert "000123456722000124" in mock_get.call_args.args[0]
+
+
+def test_prewarm_holdings():
+    """Test prewarm_holdings fetches each valid CIK and reports the results."""
+    with patch(
+        "main.fetch_holdings_df",
+        side_effect=lambda cik: None if cik == "2" else MagicMock(),
+    ) as mock_fetch:
+        results = prewarm_holdings(["1", " 2 ", "not-a-cik"])
+
+    assert results == {"1": True, "2": False}
+    assert sorted(call.args[0] for call in mock_fetch.call_args_list) == ["1", "2"]
+
+
+def test_prewarm_holdings_failed_cik():
+    """Test prewarm_holdings still reports other CIKs when one of them raises."""
+
+    def fetch(cik):
+        if cik == "2":
+            raise etree.XMLSyntaxError("Document is empty", None, 1, 1)
+        if cik == "3":
+            raise KeyError("accessionNumber")
+        return MagicMock()
+
+    with (
+        patch("main.fetch_holdings_df", side_effect=fetch),
+        patch("main.logger") as mock_logger,
+    ):
+        results = prewarm_holdings(["1", "2", "3", "4"])
+
+    assert results == {"1": True, "2": False, "3": False, "4": True}
+    assert mock_logger.exception.call_count == 2
+
+
+def test_start_prewarm():
+    """Test start_prewarm warms the given CIKs in the background once."""
+    with patch("main.prewarm_holdings") as mock_prewarm:
+        thread = start_prewarm(("1", "2"))
+        assert thread is not None
+        thread.join(timeout=5)
+
+        assert start_prewarm(("1", "2")) is thread
+        assert start_prewarm(()) is None
+
+    mock_prewarm.assert_called_once_with(("1", "2"))
+
+
+def test_build_pie_chart_cached():
+    """Test build_pie_chart reuses the figure for the same slices."""
+    fig = build_pie_chart(("Test Stock", "Other"), (1000.0, 500.0), 3.0, 15)
+
+    assert build_pie_chart(("Test Stock", "Other"), (1000.0, 500.0), 3.0, 15) is fig
+    assert build_pie_chart(("Test Stock", "Other"), (1000.0, 500.0), 5.0, 15) is not fig
+    assert build_pie_chart(("Test Stock", "Other"), (1000.0, 500.0), 3.0, 5) is not fig
+
+
+def test_build_pie_chart_repeated_titles():
+    """Test holdings that share a title stay separate slices."""
+    fig = build_pie_chart(("Issuer", "Issuer", "Other"), (30.0, 20.0, 10.0), 3.0, 15)
+
+    assert list(fig.data[0].labels) == ["Issuer", "Issuer (2)", "Other"]
+    assert list(fig.data[0].values) == [30.0, 20.0, 10.0]
+
+
+def test_fetch_holdings_json_timeout():
+    """Test fetch_holdings_df reports a timeout fetching the submissions JSON."""
+    with (
+        patch("requests.Session.get", side_effect=requests.Timeout("timed out")),
+        patch("streamlit.error") as mock_st_error,
+    ):
+        holdings = fetch_holdings_df("1234567890")
+
+        assert holdings is None
+        mock_st_error.assert_called_once_with(
+            "Failed to fetch JSON data. Error: timed out"
+        )
+
+
+def test_fetch_holdings_xml_read_timeout(
+    mock_successful_json_response, mock_successful_xml_response
+):
+    """Test fetch_holdings_df reports a timeout partway through the XML download."""
+    mock_successful_xml_response.iter_content.side_effect = requests.ConnectionError(
+        "read timed out"
+    )
+    with patch("requests.Session.get") as mock_get:
+        mock_get.side_effect = [
+            mock_successful_json_response,
+            mock_successful_xml_response,
+        ]
+
+        with patch("streamlit.error") as mock_st_error:
+            holdings = fetch_holdings_df("1234567890")
+
+            assert holdings is None
+            mock_st_error.assert_called_once_with(
+                "Failed to fetch XML. Error: read timed out"
+            )
+
+
+def test_fetch_holdings_df_retries_failed_fetch(
+    mock_successful_json_response, mock_successful_xml_response
+):
+    """Test a failed SEC request is not cached, so the next call retries it."""
+    with (
+        patch("requests.Session.get") as mock_get,
+        patch("streamlit.error") as mock_st_error,
+    ):
+        mock_get.side_effect = [
+            requests.Timeout("timed out"),
+            mock_successful_json_response,
+            requests.Timeout("timed out"),
+            mock_successful_xml_response,
+        ]
+
+        assert fetch_holdings_df("1234567890") is None
+        assert fetch_holdings_df("1234567890") is None
+        holdings = fetch_holdings_df("1234567890")
+
+        assert holdings is not None
+        assert len(holdings) == 2
+        assert mock_get.call_count == 4
+        assert mock_st_error.call_count == 2
+
+
+def test_fetch_holdings_df_retries_error_status(
+    mock_successful_json_response,
+    mock_error_xml_response,
+    mock_successful_xml_response,
+):
+    """Test an error status from the SEC is not cached for the filing TTL."""
+    with (
+        patch("requests.Session.get") as mock_get,
+        patch("streamlit.error") as mock_st_error,
+    ):
+        mock_get.side_effect = [
+            mock_successful_json_response,
+            mock_error_xml_response,
+            mock_successful_xml_response,
+        ]
+
+        assert fetch_holdings_df("1234567890") is None
+        holdings = fetch_holdings_df("1234567890")
+
+        assert holdings is not None
+        assert mock_get.call_count == 3
+        mock_st_error.assert_called_once_with("Failed to fetch XML")
+
+
 @pytest.mark.parametrize("with_holdings", [True, False])
 def test_main_function(with_holdings, monkeypatch):
     """Test the main function with and without holdings data."""
@@ -173,24 +427,15 @@ def test_main_function(with_holdings, monkeypatch):
         patch("streamlit.expander") as mock_expander,
         patch("streamlit.button", return_value=True) as mock_button,
         patch("streamlit.spinner") as mock_spinner,
-        patch("main.fetch_holdings") as mock_fetch,
+        patch("main.fetch_holdings_df") as mock_fetch,
     ):
         if with_holdings:
-            mock_data = [
-                {
-                    "Title": "Test Stock",
-                    "CUSIP": "123456789",
-                    "Balance": "100",
-                    "Value": "1000",
-                },
-                {
-                    "Title": "Test Bond",
-                    "CUSIP": "987654321",
-                    "Balance": "50",
-                    "Value": "500",
-                },
-            ]
-            mock_fetch.return_value = mock_data
+            mock_df = MagicMock()
+            mock_df.__getitem__.return_value = mock_df
+            mock_str = MagicMock()
+            mock_str.contains.return_value = mock_df
+            type(mock_df).str = mock_str
+            mock_fetch.return_value = mock_df
         else:
             mock_fetch.return_value = None
 
@@ -201,22 +446,9 @@ def test_main_function(with_holdings, monkeypatch):
         with (
             patch("streamlit.success") as mock_success,
             patch("streamlit.dataframe"),
-            patch("pandas.DataFrame") as mock_df_constructor,
-            patch(
-                "matplotlib.pyplot.subplots", return_value=(MagicMock(), MagicMock())
-            ),
-            patch("streamlit.pyplot"),
+            patch("main.build_pie_chart"),
+            patch("streamlit.plotly_chart"),
         ):
-            if with_holdings:
-                mock_df = MagicMock()
-                mock_df.__getitem__.return_value = mock_df
-                mock_df.copy.return_value = mock_df
-                mock_df.dropna.return_value = mock_df
-                mock_df_constructor.return_value = mock_df
-                mock_str = MagicMock()
-                mock_str.contains.return_value = mock_df
-                type(mock_df).str = mock_str
-
             main()
 
             mock_title.assert_called_once()
@@ -227,16 +459,75 @@ def test_main_function(with_holdings, monkeypatch):
 
             if with_holdings:
                 mock_success.assert_called_once()
-                assert hasattr(st.session_state, "holdings_df")
+                assert st.session_state.holdings_df is mock_df
+
+
+@pytest.mark.parametrize(
+    "threshold_pct, top_n, expected_titles, expected_values",
+    [
+        # Only the top_n largest holdings keep their own slice
+        (3.0, 2, ("A", "B", "Other (4 holdings)"), (50.0, 30.0, 20.0)),
+        # Holdings below the threshold are grouped even within the top_n
+        (
+            3.0,
+            30,
+            ("A", "B", "C", "D", "E", "Other (1 holdings)"),
+            (50.0, 30.0, 10.0, 5.0, 3.0, 2.0),
+        ),
+        # No 'Other' slice when every holding is shown individually
+        (0.5, 30, ("A", "B", "C", "D", "E", "F"), (50.0, 30.0, 10.0, 5.0, 3.0, 2.0)),
+    ],
+)
+def test_main_pie_chart_data(
+    threshold_pct, top_n, expected_titles, expected_values, monkeypatch
+):
+    """Test main groups holdings into the pie chart slices it plots."""
+    monkeypatch.setattr(st, "session_state", DotDict())
+    monkeypatch.setattr("main.is_rate_limited", lambda *args: False)
+
+    holdings_df = pd.DataFrame(
+        {
+            "Title": ["C", "A", "F", "E", "B", "D", None, "G"],
+            "CUSIP": ["3", "1", "6", "5", "2", "4", "7", "8"],
+            "Balance": [1, 1, 1, 1, 1, 1, 1, 1],
+            "Value": [10.0, 50.0, 2.0, 3.0, 30.0, 5.0, 100.0, float("nan")],
+        }
+    )
+    holdings_df[TITLE_SEARCH_COLUMN] = holdings_df["Title"].str.lower()
+
+    with (
+        patch("streamlit.title"),
+        patch(
+            "streamlit.text_input",
+            side_effect=lambda label, value: (
+                "1234567890" if label == "Enter CIK" else ""
+            ),
+        ),
+        patch("streamlit.slider", side_effect=[threshold_pct, top_n]),
+        patch("streamlit.expander"),
+        patch("streamlit.button", return_value=True),
+        patch("streamlit.spinner"),
+        patch("streamlit.success"),
+        patch("streamlit.dataframe"),
+        patch("streamlit.plotly_chart") as mock_plotly_chart,
+        patch("main.fetch_holdings_df", return_value=holdings_df),
+        patch("main.build_pie_chart") as mock_build_pie_chart,
+    ):
+        main()
+
+    mock_build_pie_chart.assert_called_once_with(
+        expected_titles, expected_values, threshold_pct, top_n
+    )
+    mock_plotly_chart.assert_called_once_with(mock_build_pie_chart.return_value)
 
 
 def test_rate_limiting(monkeypatch):
     """Test that rate limiting warning is triggered when client exceeds allowed requests."""
-    from main import IP_REQUESTS, MAX_REQUESTS, main
+    from main import IP_REQUESTS, MAX_REQUESTS, RATE_LIMIT, main
 
     test_ip = "127.0.0.1"
     current = time.time()
-    IP_REQUESTS[test_ip] = [current - 1 for _ in range(MAX_REQUESTS)]
+    IP_REQUESTS[test_ip] = (int(current // RATE_LIMIT), 0, MAX_REQUESTS)
 
     fake_ctx = MagicMock()
     fake_ctx.request.client.host = test_ip
@@ -245,10 +536,44 @@ def test_rate_limiting(monkeypatch):
     monkeypatch.setattr("streamlit.text_input", lambda *args, **kwargs: "1234567890")
     monkeypatch.setattr("streamlit.button", lambda *args, **kwargs: True)
     monkeypatch.setattr("streamlit.spinner", lambda x: x)
-    monkeypatch.setattr("main.fetch_holdings", lambda x: None)
+    monkeypatch.setattr("main.fetch_holdings_df", lambda x: None)
 
     with patch("main.st.warning") as mock_warning:
         main()
         mock_warning.assert_called_once_with(
             "Rate limit exceeded. Please try again later."
         )
+
+
+def test_is_rate_limited_sliding_window():
+    """Test that the sliding window blocks bursts and recovers as windows expire."""
+    from main import IP_REQUESTS, MAX_REQUESTS, RATE_LIMIT
+
+    test_ip = "10.0.0.1"
+    IP_REQUESTS.pop(test_ip, None)
+    start = 100 * RATE_LIMIT
+
+    for _ in range(MAX_REQUESTS):
+        assert not is_rate_limited(test_ip, start)
+    assert is_rate_limited(test_ip, start)
+
+    # Early in the next window the previous burst still counts almost fully
+    assert not is_rate_limited(test_ip, start + RATE_LIMIT + 1)
+    assert is_rate_limited(test_ip, start + RATE_LIMIT + 1)
+    # Two windows later the burst no longer counts at all
+    assert not is_rate_limited(test_ip, start + 2 * RATE_LIMIT)
+
+
+def test_sweep_rate_limits():
+    """Test that sweeping drops only IPs whose windows can no longer count."""
+    from main import IP_REQUESTS, RATE_LIMIT
+
+    now = 100 * RATE_LIMIT
+    IP_REQUESTS.clear()
+    IP_REQUESTS["active"] = (100, 0, 1)
+    IP_REQUESTS["previous"] = (99, 0, 1)
+    IP_REQUESTS["stale"] = (98, 0, 1)
+
+    sweep_rate_limits(now)
+
+    assert set(IP_REQUESTS) == {"active", "previous"}